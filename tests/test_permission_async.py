@@ -12,7 +12,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import copy
+import asyncio
+import functools
+import types
 from typing import Any, Optional, Union
 import unittest
 import unittest.mock as mock
@@ -27,120 +29,198 @@ from google.generativeai.types import retriever_types as retriever_services
 
 from google.generativeai import client
 from absl.testing import absltest
-from absl.testing import parameterized
 
+_ROLE_WRITER = permission_services.to_role("writer")
+_ROLE_READER = permission_services.to_role("reader")
+_GT_EVERYONE = permission_services.to_grantee_type("everyone")
+
+_PERM1 = protos.Permission(
+    name="corpora/demo-corpus/permissions/123456789",
+    role=_ROLE_WRITER,
+    grantee_type=_GT_EVERYONE,
+)
+_PERM2 = protos.Permission(
+    name="corpora/demo-corpus/permissions/987654321",
+    role=_ROLE_READER,
+    grantee_type=_GT_EVERYONE,
+    email_address="_",
+)
+
+_CANNED = {
+    "corpus": protos.Corpus(
+        name="corpora/demo-corpus",
+        display_name="demo-corpus",
+        create_time="2000-01-01T01:01:01.123456Z",
+        update_time="2000-01-01T01:01:01.123456Z",
+    ),
+    "permission": _PERM1,
+    "updated_permission": protos.Permission(
+        name="corpora/demo-corpus/permissions/123456789",
+        role=_ROLE_READER,
+        grantee_type=_GT_EVERYONE,
+    ),
+}
+
+
+class _AList:
+    """Async iterator over already-computed items, standing in for the async pager."""
+
+    def __init__(self, items):
+        self._it = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._it)
+        except StopIteration:
+            raise StopAsyncIteration from None
+
+
+def _recording(fn, record):
+    """Wraps an async handler so every request it receives is passed to `record` first."""
+
+    @functools.wraps(fn)
+    async def wrapper(request, **kwargs):
+        record(request)
+        return await fn(request, **kwargs)
+
+    return wrapper
+
+
+async def _create_corpus(
+    request: protos.CreateCorpusRequest,
+    **kwargs,
+) -> protos.Corpus:
+    return _CANNED["corpus"]
+
+
+# `models.get_tuned_model` is sync and may pass only `name=`, so this handler records the request
+# it builds itself instead of going through `_recording`.
+def _get_tuned_model(
+    record,
+    responses,
+    request: Optional[protos.GetTunedModelRequest] = None,
+    *,
+    name=None,
+    **kwargs,
+) -> protos.TunedModel:
+    if request is None:
+        request = protos.GetTunedModelRequest(name=name)
+    record(request)
+    return responses.get_tuned_model
+
+
+async def _create_permission(
+    request: protos.CreatePermissionRequest,
+) -> protos.Permission:
+    return _CANNED["permission"]
+
+
+async def _delete_permission(
+    request: protos.DeletePermissionRequest,
+) -> None:
+    return None
+
+
+async def _get_permission(
+    request: protos.GetPermissionRequest,
+) -> protos.Permission:
+    return _CANNED["permission"]
+
+
+async def _list_permissions(
+    request: protos.ListPermissionsRequest,
+) -> _AList:
+    return _AList([_PERM1, _PERM2])
+
+
+async def _update_permission(
+    request: protos.UpdatePermissionRequest,
+) -> protos.Permission:
+    return _CANNED["updated_permission"]
+
+
+async def _transfer_ownership(
+    request: protos.TransferOwnershipRequest,
+) -> protos.TransferOwnershipResponse:
+    return protos.TransferOwnershipResponse()
+
+
+# The SDK converts every response with `to_dict`, so the canned protos are never mutated and
+# can be shared between tests.
+_HANDLERS = {
+    "create_corpus": _create_corpus,
+    "create_permission": _create_permission,
+    "delete_permission": _delete_permission,
+    "get_permission": _get_permission,
+    "list_permissions": _list_permissions,
+    "update_permission": _update_permission,
+    "transfer_ownership": _transfer_ownership,
+}
+
+
+_INVALID_NAME_CASES = (
+    ("no_information_provided", {}),
+    ("permission_id_missing", {"resource_name": "demo-corpus"}),
+    ("resource_name_missing", {"permission_id": "123456789"}),
+    ("invalid_corpus_name", {"name": "corpora/demo-corpus-/permissions/123456789"}),
+    ("invalid_permission_id", {"name": "corpora/demo-corpus/permissions/*"}),
+    (
+        "invalid_tuned_model_name",
+        {"name": "tunedModels/my_text_model/permissions/123456789"},
+    ),
+    ("unsupported_resource_name_1", {"name": "dataset/demo-corpus/permissions/123456789"}),
+    (
+        "unsupported_resource_type_2",
+        {
+            "resource_name": "my-dataset",
+            "permission_id": "123456789",
+            "resource_type": "dataset",
+        },
+    ),
+    (
+        "invlalid_full_name_format_1",
+        {"name": "corpora/demo-corpus/permissions/123456789/extra"},
+    ),
+    ("invlalid_full_name_format_2", {"name": "corpora/2323"}),
+    ("invlalid_full_name_format_3", {"name": "corpora"}),
+)
+
+
+class AsyncTests(absltest.TestCase, unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = types.SimpleNamespace()
+
+        # Every client the SDK asks for (retriever_async, permission_async, model) is the fake.
+        patcher = mock.patch.object(
+            client._client_manager, "get_default_client", lambda name: cls.client
+        )
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
 
-class AsyncTests(parameterized.TestCase, unittest.IsolatedAsyncioTestCase):
-    def setUp(self):
-        self.client = unittest.mock.AsyncMock()
-
-        client._client_manager.clients["retriever_async"] = self.client
-        client._client_manager.clients["permission_async"] = self.client
-        client._client_manager.clients["model"] = self.client
-
-        self.observed_requests = []
+        # Shared by every test in the class; `asyncSetUp` empties them in place so the handlers
+        # can keep their references.
+        cls.observed_requests = []
+        _record = cls.observed_requests.append
 
-        self.responses = {}
+        cls.responses = types.SimpleNamespace()
 
-        def add_client_method(f):
-            name = f.__name__
-            setattr(self.client, name, f)
-            return f
+        for name, fn in _HANDLERS.items():
+            setattr(cls.client, name, _recording(fn, _record))
+        cls.client.get_tuned_model = functools.partial(_get_tuned_model, _record, cls.responses)
 
-        @add_client_method
-        async def create_corpus(
-            request: protos.CreateCorpusRequest,
-            **kwargs,
-        ) -> protos.Corpus:
-            self.observed_requests.append(request)
-            return protos.Corpus(
-                name="corpora/demo-corpus",
-                display_name="demo-corpus",
-                create_time="2000-01-01T01:01:01.123456Z",
-                update_time="2000-01-01T01:01:01.123456Z",
-            )
+    async def asyncSetUp(self):
+        self.observed_requests.clear()
+        vars(self.responses).clear()
 
-        @add_client_method
-        def get_tuned_model(
-            request: Optional[protos.GetTunedModelRequest] = None,
-            *,
-            name=None,
-            **kwargs,
-        ) -> protos.TunedModel:
-            if request is None:
-                request = protos.GetTunedModelRequest(name=name)
-            self.assertIsInstance(request, protos.GetTunedModelRequest)
-            self.observed_requests.append(request)
-            response = copy.copy(self.responses["get_tuned_model"])
-            return response
-
-        @add_client_method
-        async def create_permission(
-            request: protos.CreatePermissionRequest,
-        ) -> protos.Permission:
-            self.observed_requests.append(request)
-            return protos.Permission(
-                name="corpora/demo-corpus/permissions/123456789",
-                role=permission_services.to_role("writer"),
-                grantee_type=permission_services.to_grantee_type("everyone"),
-            )
-
-        @add_client_method
-        async def delete_permission(
-            request: protos.DeletePermissionRequest,
-        ) -> None:
-            self.observed_requests.append(request)
-            return None
-
-        @add_client_method
-        async def get_permission(
-            request: protos.GetPermissionRequest,
-        ) -> protos.Permission:
-            self.observed_requests.append(request)
-            return protos.Permission(
-                name="corpora/demo-corpus/permissions/123456789",
-                role=permission_services.to_role("writer"),
-                grantee_type=permission_services.to_grantee_type("everyone"),
-            )
-
-        @add_client_method
-        async def list_permissions(
-            request: protos.ListPermissionsRequest,
-        ) -> protos.ListPermissionsResponse:
-            self.observed_requests.append(request)
-
-            async def results():
-                yield protos.Permission(
-                    name="corpora/demo-corpus/permissions/123456789",
-                    role=permission_services.to_role("writer"),
-                    grantee_type=permission_services.to_grantee_type("everyone"),
-                )
-                yield protos.Permission(
-                    name="corpora/demo-corpus/permissions/987654321",
-                    role=permission_services.to_role("reader"),
-                    grantee_type=permission_services.to_grantee_type("everyone"),
-                    email_address="_",
-                )
-
-            return results()
-
-        @add_client_method
-        async def update_permission(
-            request: protos.UpdatePermissionRequest,
-        ) -> protos.Permission:
-            self.observed_requests.append(request)
-            return protos.Permission(
-                name="corpora/demo-corpus/permissions/123456789",
-                role=permission_services.to_role("reader"),
-                grantee_type=permission_services.to_grantee_type("everyone"),
-            )
-
-        @add_client_method
-        async def transfer_ownership(
-            request: protos.TransferOwnershipRequest,
-        ) -> protos.TransferOwnershipResponse:
-            self.observed_requests.append(request)
-            return protos.TransferOwnershipResponse()
+    async def _corpus_and_perm(self):
+        x = await retriever.create_corpus_async("demo-corpus")
+        perm = await x.permissions.create_async("writer", "everyone")
+        return x, perm
 
     async def test_create_permission_success(self):
         x = await retriever.create_corpus_async("demo-corpus")
@@ -165,22 +245,19 @@ class AsyncTests(parameterized.TestCase, unittest.IsolatedAsyncioTestCase):
             )
 
     async def test_delete_permission(self):
-        x = await retriever.create_corpus_async("demo-corpus")
-        perm = await x.permissions.create_async("writer", "everyone")
+        x, perm = await self._corpus_and_perm()
         await perm.delete_async()
         self.assertIsInstance(self.observed_requests[-1], protos.DeletePermissionRequest)
 
     async def test_get_permission_with_full_name(self):
-        x = await retriever.create_corpus_async("demo-corpus")
-        perm = await x.permissions.create_async("writer", "everyone")
+        x, perm = await self._corpus_and_perm()
         fetch_perm = await permission.get_permission_async(name=perm.name)
         self.assertIsInstance(fetch_perm, permission_services.Permission)
         self.assertIsInstance(self.observed_requests[-1], protos.GetPermissionRequest)
         self.assertEqual(fetch_perm, perm)
 
     async def test_get_permission_with_resource_name_and_id_1(self):
-        x = await retriever.create_corpus_async("demo-corpus")
-        perm = await x.permissions.create_async("writer", "everyone")
+        x, perm = await self._corpus_and_perm()
         fetch_perm = await permission.get_permission_async(
             resource_name="corpora/demo-corpus", permission_id=123456789
         )
@@ -202,57 +279,14 @@ class AsyncTests(parameterized.TestCase, unittest.IsolatedAsyncioTestCase):
         self.assertIsInstance(fetch_perm, permission_services.Permission)
         self.assertIsInstance(self.observed_requests[-1], protos.GetPermissionRequest)
 
-    @parameterized.named_parameters(
-        dict(
-            testcase_name="no_information_provided",
-        ),
-        dict(
-            testcase_name="permission_id_missing",
-            resource_name="demo-corpus",
-        ),
-        dict(
-            testcase_name="resource_name_missing",
-            permission_id="123456789",
-        ),
-        dict(
-            testcase_name="invalid_corpus_name", name="corpora/demo-corpus-/permissions/123456789"
-        ),
-        dict(testcase_name="invalid_permission_id", name="corpora/demo-corpus/permissions/*"),
-        dict(
-            testcase_name="invalid_tuned_model_name",
-            name="tunedModels/my_text_model/permissions/123456789",
-        ),
-        dict(
-            testcase_name="unsupported_resource_name_1",
-            name="dataset/demo-corpus/permissions/123456789",
-        ),
-        dict(
-            testcase_name="unsupported_resource_type_2",
-            resource_name="my-dataset",
-            permission_id="123456789",
-            resource_type="dataset",
-        ),
-        dict(
-            testcase_name="invlalid_full_name_format_1",
-            name="corpora/demo-corpus/permissions/123456789/extra",
-        ),
-        dict(testcase_name="invlalid_full_name_format_2", name="corpora/2323"),
-        dict(testcase_name="invlalid_full_name_format_3", name="corpora"),
-    )
-    async def test_get_permission_with_invalid_name_constructs(
-        self,
-        name=None,
-        resource_name=None,
-        permission_id=None,
-        resource_type=None,
-    ):
-        with self.assertRaises(ValueError):
-            fetch_perm = await permission.get_permission_async(
-                name=name,
-                resource_name=resource_name,
-                permission_id=permission_id,
-                resource_type=resource_type,
-            )
+    async def test_get_permission_with_invalid_name_constructs(self):
+        results = await asyncio.gather(
+            *(permission.get_permission_async(**kwargs) for _, kwargs in _INVALID_NAME_CASES),
+            return_exceptions=True,
+        )
+        for (testcase_name, _), result in zip(_INVALID_NAME_CASES, results):
+            with self.subTest(testcase_name):
+                self.assertIsInstance(result, ValueError)
 
     async def test_list_permission(self):
         x = await retriever.create_corpus_async("demo-corpus")
@@ -267,25 +301,24 @@ class AsyncTests(parameterized.TestCase, unittest.IsolatedAsyncioTestCase):
         self.assertIsInstance(self.observed_requests[-1], protos.ListPermissionsRequest)
 
     async def test_update_permission_success(self):
-        x = await retriever.create_corpus_async("demo-corpus")
-        perm = await x.permissions.create_async("writer", "everyone")
+        x, perm = await self._corpus_and_perm()
         updated_perm = await perm.update_async({"role": permission_services.to_role("reader")})
         self.assertIsInstance(updated_perm, permission_services.Permission)
         self.assertIsInstance(self.observed_requests[-1], protos.UpdatePermissionRequest)
 
     async def test_update_permission_failure_restricted_update_path(self):
-        x = await retriever.create_corpus_async("demo-corpus")
-        perm = await x.permissions.create_async("writer", "everyone")
+        x, perm = await self._corpus_and_perm()
         with self.assertRaises(ValueError):
             updated_perm = await perm.update_async(
                 {"grantee_type": permission_services.to_grantee_type("user")}
             )
 
     async def test_transfer_ownership(self):
-        self.responses["get_tuned_model"] = protos.TunedModel(
+        self.responses.get_tuned_model = protos.TunedModel(
             name="tunedModels/fake-pig-001", base_model="models/dance-monkey-007"
         )
         x = models.get_tuned_model("tunedModels/fake-pig-001")
+        self.assertIsInstance(self.observed_requests[-1], protos.GetTunedModelRequest)
         response = await x.permissions.transfer_ownership_async(email_address="_")
         self.assertIsInstance(self.observed_requests[-1], protos.TransferOwnershipRequest)
 